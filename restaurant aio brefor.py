@@ -1,23 +1,56 @@
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import re
 import os
 import json
+import time
+import types
+import pathlib
+import functools
 import datetime
+from dataclasses import dataclass, field
 import aiosqlite
 import asyncio
-import nest_asyncio
 from telegram.error import TelegramError
 from telegram import ReplyKeyboardMarkup, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, CallbackContext
-import traceback
+from telegram.request import HTTPXRequest
 
-# ✅ إعداد سجل الأخطاء
-logging.basicConfig(level=logging.INFO)
+# ✅ orjson أسرع بعدة مرات من مكتبة json القياسية — نستخدمه إن كان مثبتًا
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ✅ إعداد سجل الأخطاء: التنسيق والكتابة يتمان في خيط خلفي حتى لا يتوقف الـ event loop
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+def setup_logging(level=logging.INFO):
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers.clear()
+    root.addHandler(QueueHandler(log_queue))
+
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # ✅ مسار قاعدة البيانات
 DB_PATH = "restaurant_orders.db"
 
+# ✅ ضعه True في ملف الإعدادات (db_network_mode) إذا كانت قاعدة البيانات على قرص شبكي (NFS)
+# لأن وضع WAL لا يعمل بأمان على أنظمة الملفات الشبكية
+DB_NETWORK_MODE = False
+
 # ✅ دالة اتصال آمن بـ aiosqlite
 async def get_db_connection():
     try:
@@ -26,13 +59,22 @@ async def get_db_connection():
         logger.error(f"❌ فشل الاتصال بقاعدة البيانات: {e}")
         return None
 
-# ✅ إنشاء الجداول الأساسية
+# ✅ إنشاء الجداول الأساسية وفتح الاتصال الدائم بقاعدة البيانات
 async def initialize_database():
+    db = await get_db_connection()
+    if db is None:
+        logger.error("❌ الاتصال بقاعدة البيانات فشل. لم يتم إنشاء الجداول.")
+        return None
+
     try:
-        db = await get_db_connection()
-        if db is None:
-            logger.error("❌ الاتصال بقاعدة البيانات فشل. لم يتم إنشاء الجداول.")
-            return
+        # ✅ ضبط SQLite لرفع سرعة الكتابة: WAL يلغي fsync عند كل COMMIT
+        journal_mode = "DELETE" if DB_NETWORK_MODE else "WAL"
+        await db.execute(f"PRAGMA journal_mode={journal_mode}")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute("PRAGMA busy_timeout=5000")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA cache_size=-20000")
+        await db.execute("PRAGMA mmap_size=268435456")
 
         await db.execute("""
             CREATE TABLE IF NOT EXISTS orders (
@@ -41,10 +83,40 @@ async def initialize_database():
                 order_number INTEGER,
                 restaurant TEXT,
                 total_price INTEGER,
-                timestamp TEXT
+                timestamp INTEGER NOT NULL
             )
         """)
 
+        # ✅ ترحيل القواعد القديمة: الطابع الزمني نصي → epoch صحيح، والسعر → عدد صحيح
+        # المقارنة على أعداد أسرع من تحويل النص في كل صف وتوفر مساحة في كاش الصفحات
+        async with db.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'orders'"
+        ) as cursor:
+            schema_row = await cursor.fetchone()
+        if schema_row and "timestamp TEXT" in schema_row[0]:
+            await db.execute("BEGIN IMMEDIATE")
+            await db.execute("""
+                CREATE TABLE orders_new (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    order_id TEXT,
+                    order_number INTEGER,
+                    restaurant TEXT,
+                    total_price INTEGER,
+                    timestamp INTEGER NOT NULL
+                )
+            """)
+            await db.execute("""
+                INSERT INTO orders_new (id, order_id, order_number, restaurant, total_price, timestamp)
+                SELECT id, order_id, order_number, restaurant,
+                       CAST(total_price AS INTEGER),
+                       CAST(strftime('%s', timestamp, 'utc') AS INTEGER)
+                FROM orders
+            """)
+            await db.execute("DROP TABLE orders")
+            await db.execute("ALTER TABLE orders_new RENAME TO orders")
+            await db.commit()
+            logger.info("✅ تم ترحيل جدول الطلبات إلى الطوابع الزمنية الرقمية.")
+
         await db.execute("""
             CREATE TABLE IF NOT EXISTS delivery_persons (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -54,26 +126,89 @@ async def initialize_database():
             )
         """)
 
+        # ✅ فهارس تجعل استعلامات الدليفري والبحث بمعرف الطلب O(log n) بدل مسح كامل
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_delivery_restaurant
+            ON delivery_persons(restaurant, name)
+        """)
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_orders_order_id
+            ON orders(order_id)
+        """)
+        await db.execute("""
+            CREATE INDEX IF NOT EXISTS idx_orders_ts_price
+            ON orders(timestamp, total_price)
+        """)
+
+        # ✅ جدول تجميعي يومي — تقرأ منه الإحصائيات بدل إعادة مسح جدول الطلبات
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day TEXT PRIMARY KEY,
+                cnt INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+        # ✅ تعبئة لمرة واحدة: طلبات ما قبل الترقية تدخل المجاميع اليومية
+        # وإلا اختفت كل الطلبات القديمة من الإحصائيات
+        async with db.execute("SELECT COUNT(*) FROM daily_stats") as cursor:
+            rollup_count = (await cursor.fetchone())[0]
+        if rollup_count == 0:
+            await db.execute("""
+                INSERT INTO daily_stats (day, cnt, total)
+                SELECT date(timestamp, 'unixepoch', 'localtime'),
+                       COUNT(*),
+                       COALESCE(SUM(total_price), 0)
+                FROM orders
+                GROUP BY 1
+            """)
+
+        # ✅ مجاميع السنوات المقفلة — تُحسب مرة واحدة ولا تتغير بعدها
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS yearly_totals (
+                year INTEGER PRIMARY KEY,
+                cnt INTEGER NOT NULL DEFAULT 0,
+                total INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        await db.execute("ANALYZE")
+
         await db.commit()
-        await db.close()
         logger.info("✅ تم التأكد من وجود جدول الطلبات وجدول الدليفري.")
     except Exception as e:
         logger.error(f"❌ خطأ أثناء إنشاء الجداول: {e}")
 
-# ✅ تحميل الإعدادات من ملفات JSON داخل مجلد config
+    return db
+
+
+# ✅ إغلاق الاتصال الدائم عند إيقاف البوت
+async def close_database(application):
+    db = application.bot_data.get("db")
+    if db is not None:
+        # ✅ كتابة أي طلبات متبقية في الطابور قبل الإغلاق
+        await _flush_insert_batch(db, application.bot_data["db_lock"])
+        await db.close()
+        logger.info("✅ تم إغلاق الاتصال بقاعدة البيانات.")
+
+    db_read = application.bot_data.get("db_read")
+    if db_read is not None and db_read is not db:
+        await db_read.close()
+
+# ✅ تحميل الإعدادات من ملفات JSON داخل مجلد config — تُقرأ مرة واحدة وتُحفظ في الذاكرة
+@functools.lru_cache(maxsize=1)
 def load_config():
-    current_dir = os.path.dirname(__file__)
-    config_dir = os.path.join(current_dir, "config")
+    config_dir = pathlib.Path(__file__).parent / "config"
 
-    json_files = [f for f in os.listdir(config_dir) if f.endswith(".json")]
-    if not json_files:
+    config_path = next(config_dir.glob("*.json"), None)
+    if config_path is None:
         raise FileNotFoundError("❌ لا يوجد أي ملف إعداد في مجلد config.")
 
-    config_path = os.path.join(config_dir, json_files[0])
-    with open(config_path, "r", encoding="utf-8") as f:
-        config = json.load(f)
+    with open(config_path, "rb") as f:
+        raw = f.read()
+    config = orjson.loads(raw) if orjson is not None else json.loads(raw)
 
-    return config
+    # ✅ نسخة للقراءة فقط حتى لا تعدّل المعالجات الإعدادات بالخطأ
+    return types.MappingProxyType(config)
 
 # ✅ متغيرات عامة سيتم تحميلها لاحقًا من config
 TOKEN = None
@@ -85,9 +220,238 @@ RESTAURANT_COMPLAINTS_CHAT_ID = None
 pending_orders = {}
 pending_locations = {}
 
+# ✅ يحمي تسلسلات القراءة-ثم-التعديل على pending_orders عند المعالجة المتزامنة
+pending_orders_lock = asyncio.Lock()
+
+# ✅ فهرس ثانوي: رقم الطلب → معرف الطلب، للوصول المباشر في معالجات التقييم
+order_number_to_id = {}
+
+
+# ✅ بيانات الطلب المعلق — الحقول تُستخرج مرة واحدة عند وصول الطلب
+# فتقرأها بقية المعالجات كخصائص بدل إعادة تحليل النص بالأنماط في كل مرة
+@dataclass(slots=True)
+class PendingOrder:
+    order_details: str
+    order_number: str
+    total_price: int
+    restaurant: str
+    message_id: int
+    channel_message_id: int
+    location: tuple = None
+    inserted_at: float = field(default_factory=time.monotonic)
+
+
+# ✅ إزالة طلب من الذاكرة مع تنظيف الفهرس الثانوي
+def discard_pending_order(order_id):
+    data = pending_orders.pop(order_id, None)
+    if data and data.order_number:
+        order_number_to_id.pop(data.order_number, None)
+    return data
+
+
+# ✅ عمر الطلب المعلق قبل اعتباره متروكًا، وفاصل فحص التنظيف (بالثواني)
+PENDING_ORDER_TTL = 6 * 3600
+PENDING_SWEEP_INTERVAL = 600
+
+
+# ✅ مهمة خلفية: حذف الطلبات المعلقة المتروكة (لم يضغط أحد أزرارها) حتى لا تتسرب الذاكرة
+async def sweep_pending_orders():
+    while True:
+        await asyncio.sleep(PENDING_SWEEP_INTERVAL)
+        cutoff = time.monotonic() - PENDING_ORDER_TTL
+        async with pending_orders_lock:
+            expired = [
+                order_id for order_id, data in pending_orders.items()
+                if data.inserted_at < cutoff
+            ]
+            for order_id in expired:
+                discard_pending_order(order_id)
+        if expired:
+            logger.info(f"🧹 تم تنظيف {len(expired)} طلب/طلبات معلقة منتهية الصلاحية.")
+
+# ✅ طابور إدراج الطلبات — تتجمع الصفوف هنا وتُكتب دفعة واحدة في مهمة خلفية
+pending_inserts = []
+pending_inserts_event = asyncio.Event()
+PENDING_INSERTS_LIMIT = 10_000
+INSERT_FLUSH_INTERVAL = 0.5  # ثانية
+
+INSERT_ORDER_SQL = """
+    INSERT INTO orders (order_id, order_number, restaurant, total_price, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+# ✅ كاش قصير العمر لنتائج الإحصائيات — الضغطات المتكررة لا تعيد تنفيذ الاستعلام
+_stats_cache = {}
+STATS_TTL_CURRENT = 60      # فترات تشمل اليوم الجاري
+STATS_TTL_PAST = 3600       # فترات منتهية (أمس، الشهر الماضي)
+
+
+def _stats_cache_get(key, ttl):
+    entry = _stats_cache.get(key)
+    if entry and (ttl is None or time.monotonic() - entry[0] < ttl):
+        return entry[1]
+    return None
+
+
+def _stats_cache_put(key, result):
+    _stats_cache[key] = (time.monotonic(), result)
+
+
+UPSERT_DAILY_STATS_SQL = """
+    INSERT INTO daily_stats (day, cnt, total) VALUES (?, 1, ?)
+    ON CONFLICT(day) DO UPDATE SET cnt = cnt + 1, total = total + excluded.total
+"""
+
+# ✅ نصوص SQL ثابتة على مستوى الوحدة — النص المتطابق يعيد استخدام العبارة المحضّرة
+# في كاش pysqlite بدل إعادة التحليل والتخطيط عند كل ضغطة زر
+STATS_RANGE_SQL = """
+    SELECT COALESCE(SUM(cnt), 0), COALESCE(SUM(total), 0)
+    FROM daily_stats
+    WHERE day >= ? AND day < ?
+"""
+YEARLY_TOTALS_SQL = "SELECT cnt, total FROM yearly_totals WHERE year = ?"
+UPSERT_YEARLY_SQL = "INSERT OR REPLACE INTO yearly_totals (year, cnt, total) VALUES (?, ?, ?)"
+CLOSED_YEARS_SUM_SQL = """
+    SELECT COALESCE(SUM(cnt), 0), COALESCE(SUM(total), 0)
+    FROM yearly_totals
+    WHERE year < ?
+"""
+DELETE_DELIVERY_SQL = "DELETE FROM delivery_persons WHERE restaurant = ? AND name = ?"
+
+
+# ✅ كتابة الدفعة الحالية من الطلبات في معاملة واحدة
+async def _flush_insert_batch(db, db_lock):
+    if not pending_inserts:
+        return
+
+    batch = pending_inserts.copy()
+    del pending_inserts[:len(batch)]
+
+    try:
+        async with db_lock:
+            await db.executemany(INSERT_ORDER_SQL, batch)
+            # ✅ تحديث المجاميع اليومية ضمن نفس المعاملة (اليوم مشتق من epoch بالتوقيت المحلي)
+            await db.executemany(
+                UPSERT_DAILY_STATS_SQL,
+                [(datetime.date.fromtimestamp(row[4]).isoformat(), row[3]) for row in batch]
+            )
+            await db.commit()
+        logger.info(f"✅ تم تسجيل {len(batch)} طلب/طلبات في قاعدة البيانات دفعة واحدة.")
+    except Exception as e:
+        logger.error(f"❌ فشل تسجيل دفعة الطلبات في قاعدة البيانات: {e}")
+
+
+# ✅ مهمة خلفية: تنتظر وصول طلبات جديدة ثم تكتبها دفعة واحدة
+async def flush_pending_inserts(application):
+    db = application.bot_data["db"]
+    db_lock = application.bot_data["db_lock"]
+
+    while True:
+        try:
+            await asyncio.wait_for(pending_inserts_event.wait(), timeout=INSERT_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        pending_inserts_event.clear()
+        await _flush_insert_batch(db, db_lock)
+
+# ✅ تحديد معدل الإرسال: حد أقصى للتزامن + سقف 30 رسالة/ثانية (حد تيليغرام العام)
+# حتى لا نصطدم بأخطاء 429 وعواصف إعادة المحاولة وقت الذروة
+TG_SEND_SEM = asyncio.Semaphore(25)
+TG_RATE_LIMIT = 30  # رسالة في الثانية
+_tg_bucket_tokens = TG_RATE_LIMIT
+_tg_bucket_ts = 0.0
+
+
+# ✅ غلاف لكل الإرسالات الصادرة إلى تيليغرام
+async def tg_send(coro):
+    global _tg_bucket_tokens, _tg_bucket_ts
+    async with TG_SEND_SEM:
+        while True:
+            now = time.monotonic()
+            if now - _tg_bucket_ts >= 1.0:
+                _tg_bucket_tokens = TG_RATE_LIMIT
+                _tg_bucket_ts = now
+            if _tg_bucket_tokens > 0:
+                _tg_bucket_tokens -= 1
+                break
+            await asyncio.sleep(_tg_bucket_ts + 1.0 - now)
+        return await coro
+
+
+# ✅ الأنماط المترجمة مسبقًا — تُستخدم في مسار معالجة رسائل القناة الساخن
+_STARS_RE = re.compile(r"تقييمه بـ (\⭐+)")
+_ORDER_ID_RE = re.compile(r"معرف الطلب:\s*([\w\d]+)")
+_ORDER_NUM_RE = re.compile(r"رقم الطلب[:*`\s]*([0-9]+)")
+_TOTAL_RE = re.compile(r"المجموع الكلي[:\s]*([0-9,]+)")
+_RESTAURANT_RE = re.compile(r"المطعم[:\s]*(.+)")
+_RATING_NUM_RE = re.compile(r"رقم (\d+)")
+_DELIVERED_NUM_RE = re.compile(r"طلبه رقم\s*(\d+)")
+_DELIVERED_ID_RE = re.compile(r"معرف الطلب:\s*(\w+)")
+_CANCEL_NUM_RE = re.compile(r"إلغاء الطلب رقم[:\s]*(\d+)")
+_CANCEL_ID_RE = re.compile(r"معرف الطلب[:\s]*`?([\w\d]+)`?")
+
+# ✅ نمط موحد يستخرج كل حقول الطلب بمسح واحد للنص بدل أربع مسحات
+# اسم المطعم حتى نهاية سطره فقط ([^\n]+) — وإلا ابتلعت المجموعة بقية الرسالة مع re.S
+_ORDER_FIELDS_RE = re.compile(
+    r"رقم الطلب[:*`\s]*(?P<num>\d+)"
+    r".*?المجموع الكلي[:*`\s]*(?P<total>[\d,]+)"
+    r"(?:.*?المطعم[:\s]*(?P<rest>[^\n]+))?",
+    re.S
+)
+
+
+# ✅ أوقات التحضير المتاحة بالدقائق — بنية ثابتة تُبنى الأزرار منها عند الحاجة
+TIME_CHOICES = (5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 75, 90)
+
+
+# ✅ أزرار القبول/الرفض/الشكوى لطلب محدد
+def build_order_actions_kb(order_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ قبول الطلب", callback_data=f"accept_{order_id}")],
+        [InlineKeyboardButton("❌ رفض الطلب", callback_data=f"reject_{order_id}")],
+        [InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{order_id}")]
+    ])
+
+
+# ✅ أزرار اختيار مدة التحضير (مع تمييز الوقت المختار وزر الجاهزية بعد الاختيار)
+def build_time_kb(order_id, selected=None, with_ready=False):
+    keyboard = [
+        [InlineKeyboardButton(
+            f"✅ {t} دقيقة" if str(t) == selected else f"{t} دقيقة",
+            callback_data=f"time_{t}_{order_id}"
+        )]
+        for t in TIME_CHOICES
+    ]
+    if with_ready:
+        keyboard.append([InlineKeyboardButton("🚗 جاهز ليطلع", callback_data=f"ready_{order_id}")])
+    else:
+        keyboard.append([InlineKeyboardButton("📌 أكثر من 90 دقيقة", callback_data=f"time_90+_{order_id}")])
+    keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+# ✅ أزرار تأكيد رفض الطلب
+def build_reject_confirm_kb(order_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("✅ تأكيد رفض الطلب", callback_data=f"confirmreject_{order_id}")],
+        [InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")]
+    ])
+
+
+# ✅ أزرار قائمة الشكاوى
+def build_complaints_kb(order_id):
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("🚪 وصل الديليفري ولم يجد الزبون", callback_data=f"report_delivery_{order_id}")],
+        [InlineKeyboardButton("📞 رقم الهاتف غير صحيح", callback_data=f"report_phone_{order_id}")],
+        [InlineKeyboardButton("📍 معلومات الموقع غير دقيقة", callback_data=f"report_location_{order_id}")],
+        [InlineKeyboardButton("❓ مشكلة أخرى", callback_data=f"report_other_{order_id}")],
+        [InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")]
+    ])
+
+
 # ✅ دالة تحليل النجوم من التقييمات
 def extract_stars(text: str) -> str:
-    match = re.search(r"تقييمه بـ (\⭐+)", text)
+    match = _STARS_RE.search(text)
     return match.group(1) if match else "⭐️"
 
 
@@ -100,6 +464,18 @@ async def start(update: Update, context: CallbackContext):
             "✅ بوت المطعم جاهز لاستقبال الطلبات من القناة!",
             reply_markup=get_admin_main_menu()
         )
+
+        # ✅ لوحة إحصائيات مثبتة: تُحرَّر عند كل ضغطة بدل إرسال رسالة جديدة في كل مرة
+        stats_msg = await update.message.reply_text("📊 لوحة الإحصائيات — اضغط أحد أزرار الإحصائيات لعرضها هنا.")
+        context.chat_data["stats_msg_id"] = stats_msg.message_id
+        try:
+            await context.bot.pin_chat_message(
+                chat_id=update.effective_chat.id,
+                message_id=stats_msg.message_id,
+                disable_notification=True
+            )
+        except TelegramError as e:
+            logger.info(f"ℹ️ تعذّر تثبيت لوحة الإحصائيات (صلاحيات؟): {e}")
     except Exception as e:
         logger.error(f"❌ خطأ في دالة start: {e}")
 
@@ -121,45 +497,69 @@ async def handle_channel_order(update: Update, context: CallbackContext):
         logger.info("⛔️ تم تجاهل رسالة إلغاء الطلب (ليست طلبًا جديدًا).")
         return
 
-    logger.info(f"📥 استلم البوت طلبًا جديدًا من القناة: {text}")
+    logger.debug(f"📥 استلم البوت طلبًا جديدًا من القناة: {text}")
 
-    match = re.search(r"معرف الطلب:\s*([\w\d]+)", text)
+    match = _ORDER_ID_RE.search(text)
     if not match:
         logger.warning("⚠️ لم يتم العثور على معرف الطلب في الرسالة!")
         return
 
     order_id = match.group(1)
-    logger.info(f"🔍 تم استخراج معرف الطلب: {order_id}")
+    logger.debug(f"🔍 تم استخراج معرف الطلب: {order_id}")
 
-    location = pending_locations.pop("last_location", None)
-    message_text = text + ("\n\n📍 *تم إرفاق الموقع الجغرافي*" if location else "")
+    async with pending_orders_lock:
+        location = pending_locations.pop("last_location", None)
+    message_text = text + ("\n\n📍 تم إرفاق الموقع الجغرافي" if location else "")
 
-    keyboard = [
-        [InlineKeyboardButton("✅ قبول الطلب", callback_data=f"accept_{order_id}")],
-        [InlineKeyboardButton("❌ رفض الطلب", callback_data=f"reject_{order_id}")],
-        [InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{order_id}")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = build_order_actions_kb(order_id)
 
     try:
-        sent_message = await context.bot.send_message(
+        # ✅ نص الطلب محتوى من المستخدم وقد يحوي رموز Markdown — يُرسل نصًا خامًا
+        # حتى لا يتعثر تحليل التنسيق في خوادم تيليغرام ويُعاد الإرسال
+        sent_message = await tg_send(context.bot.send_message(
             chat_id=CASHIER_CHAT_ID,
-            text=f"🆕 *طلب جديد من القناة:*\n\n{message_text}\n\n📌 معرف الطلب: `{order_id}`",
-            parse_mode="Markdown",
+            text=f"🆕 طلب جديد من القناة:\n\n{message_text}\n\n📌 معرف الطلب: {order_id}",
             reply_markup=reply_markup
-        )
+        ))
         logger.info(f"✅ تم إرسال الطلب إلى الكاشير (order_id={order_id})")
 
-        pending_orders[order_id] = {
-            "order_details": message_text,
-            "channel_message_id": message.message_id,
-            "message_id": sent_message.message_id
-        }
+        # ✅ استخراج كل حقول الطلب مرة واحدة — بقية المعالجات تقرأها كخصائص
+        fields_match = _ORDER_FIELDS_RE.search(text)
+        if fields_match:
+            order_number = fields_match.group("num")
+            total_price = int(fields_match.group("total").replace(",", ""))
+            restaurant = fields_match.group("rest")
+            if restaurant is None:
+                # ✅ قد يرد اسم المطعم قبل المجموع الكلي — مسح احتياطي بالنمط المفرد
+                rest_match = _RESTAURANT_RE.search(text)
+                restaurant = rest_match.group(1) if rest_match else "غير معروف"
+            restaurant = restaurant.strip()
+        else:
+            num_match = _ORDER_NUM_RE.search(text)
+            order_number = num_match.group(1) if num_match else None
+            total_match = _TOTAL_RE.search(text)
+            total_price = int(total_match.group(1).replace(",", "")) if total_match else 0
+            rest_match = _RESTAURANT_RE.search(text)
+            restaurant = rest_match.group(1).strip() if rest_match else "غير معروف"
+
+        async with pending_orders_lock:
+            if order_number:
+                order_number_to_id[order_number] = order_id
+
+            pending_orders[order_id] = PendingOrder(
+                order_details=message_text,
+                order_number=order_number,
+                total_price=total_price,
+                restaurant=restaurant,
+                message_id=sent_message.message_id,
+                channel_message_id=message.message_id,
+                location=location
+            )
 
         if location:
             try:
                 latitude, longitude = location
-                await context.bot.send_location(chat_id=CASHIER_CHAT_ID, latitude=latitude, longitude=longitude)
+                await tg_send(context.bot.send_location(chat_id=CASHIER_CHAT_ID, latitude=latitude, longitude=longitude))
                 logger.info(f"✅ تم إرسال الموقع للكاشير (order_id={order_id})")
             except Exception as e:
                 logger.error(f"❌ فشل إرسال الموقع: {e}")
@@ -180,36 +580,35 @@ async def handle_channel_location(update: Update, context: CallbackContext):
     latitude = message.location.latitude
     longitude = message.location.longitude
     logger.info(f"📍 تم استلام موقع: {latitude}, {longitude}")
-    pending_locations["last_location"] = (latitude, longitude)
 
-    last_order_id = max(pending_orders.keys(), default=None)
+    async with pending_orders_lock:
+        pending_locations["last_location"] = (latitude, longitude)
+
+        # ✅ آخر طلب مُدخل: القواميس تحافظ على ترتيب الإدخال، فالعنصر الأخير هو الأحدث
+        last_order_id = next(reversed(pending_orders), None)
+        if last_order_id:
+            pending_orders[last_order_id].location = (latitude, longitude)
+            updated_order_text = f"{pending_orders[last_order_id].order_details}\n\n📍 تم إرفاق الموقع الجغرافي"
+
     if not last_order_id:
         logger.warning("⚠️ لا يوجد طلبات حالية لربط الموقع بها.")
         return
 
-    pending_orders[last_order_id]["location"] = (latitude, longitude)
-    updated_order_text = f"{pending_orders[last_order_id]['order_details']}\n\n📍 *تم إرفاق الموقع الجغرافي*"
-
-    keyboard = [
-        [InlineKeyboardButton("✅ قبول الطلب", callback_data=f"accept_{last_order_id}")],
-        [InlineKeyboardButton("❌ رفض الطلب", callback_data=f"reject_{last_order_id}")],
-        [InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{last_order_id}")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = build_order_actions_kb(last_order_id)
 
     try:
-        await context.bot.send_location(chat_id=CASHIER_CHAT_ID, latitude=latitude, longitude=longitude)
+        await tg_send(context.bot.send_location(chat_id=CASHIER_CHAT_ID, latitude=latitude, longitude=longitude))
         logger.info(f"✅ أُرسل الموقع مجددًا للكاشير (order_id={last_order_id})")
     except Exception as e:
         logger.error(f"❌ خطأ أثناء إعادة إرسال الموقع: {e}")
 
     try:
-        await context.bot.send_message(
+        # ✅ كما في الإرسال الأول: نص الطلب خام بلا parse_mode
+        await tg_send(context.bot.send_message(
             chat_id=CASHIER_CHAT_ID,
-            text=f"🆕 *طلب جديد محدث من القناة:*\n\n{updated_order_text}\n\n📌 معرف الطلب: `{last_order_id}`",
-            parse_mode="Markdown",
+            text=f"🆕 طلب جديد محدث من القناة:\n\n{updated_order_text}\n\n📌 معرف الطلب: {last_order_id}",
             reply_markup=reply_markup
-        )
+        ))
         logger.info(f"✅ تم إرسال الطلب المحدث مع الموقع (order_id={last_order_id})")
     except Exception as e:
         logger.error(f"❌ خطأ أثناء إرسال الطلب المحدث: {e}")
@@ -241,20 +640,13 @@ async def button(update: Update, context: CallbackContext):
         return
 
     order_info = pending_orders[order_id]
-    message_id = order_info.get("message_id")
-    order_details = order_info.get("order_details", "")
+    message_id = order_info.message_id
+    order_details = order_info.order_details
 
     # ✅ قبول الطلب: عرض أزرار الوقت
     if action == "accept":
-        keyboard = [
-            [InlineKeyboardButton(f"{t} دقيقة", callback_data=f"time_{t}_{order_id}")]
-            for t in [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 75, 90]
-        ]
-        keyboard.append([InlineKeyboardButton("📌 أكثر من 90 دقيقة", callback_data=f"time_90+_{order_id}")])
-        keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")])
-
         try:
-            await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
+            await query.edit_message_reply_markup(reply_markup=build_time_kb(order_id))
         except TelegramError as e:
             logger.error(f"❌ فشل في تعديل الأزرار (accept): {e}")
         return
@@ -262,69 +654,56 @@ async def button(update: Update, context: CallbackContext):
     # ✅ رفض الطلب: عرض تأكيد
     elif action == "reject":
         try:
-            await query.edit_message_reply_markup(
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ تأكيد رفض الطلب", callback_data=f"confirmreject_{order_id}")],
-                    [InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")]
-                ])
-            )
+            await query.edit_message_reply_markup(reply_markup=build_reject_confirm_kb(order_id))
         except TelegramError as e:
             logger.error(f"❌ فشل في عرض أزرار الرفض: {e}")
 
     # ✅ تأكيد الرفض النهائي
     elif action == "confirmreject":
         try:
-            await context.bot.edit_message_reply_markup(
-                chat_id=CASHIER_CHAT_ID,
-                message_id=message_id,
-                reply_markup=None
-            )
-
-            await context.bot.send_message(
-                chat_id=CHANNEL_ID,
-                text=(
-                    f"🚫 تم رفض الطلب.\n"
-                    f"📌 معرف الطلب: `{order_id}`\n"
-                    "📍 السبب: قد تكون معلومات المستخدم غير مكتملة أو غير واضحة.\n"
-                    "يمكنك اختيار *تعديل معلوماتي* لتصحيحها.\n"
-                    "أو ربما منطقتك لا تغطيها خدمة التوصيل.\n"
-                    "جرب اختيار مطعم أقرب أو المحاولة لاحقًا إن كانت هناك مشكلة لدى المطعم."
+            # ✅ الرسالتان مستقلتان (وجهتان مختلفتان) — تُرسلان بالتوازي
+            results = await asyncio.gather(
+                context.bot.edit_message_reply_markup(
+                    chat_id=CASHIER_CHAT_ID,
+                    message_id=message_id,
+                    reply_markup=None
                 ),
-                parse_mode="Markdown"
+                tg_send(context.bot.send_message(
+                    chat_id=CHANNEL_ID,
+                    text=(
+                        f"🚫 تم رفض الطلب.\n"
+                        f"📌 معرف الطلب: `{order_id}`\n"
+                        "📍 السبب: قد تكون معلومات المستخدم غير مكتملة أو غير واضحة.\n"
+                        "يمكنك اختيار *تعديل معلوماتي* لتصحيحها.\n"
+                        "أو ربما منطقتك لا تغطيها خدمة التوصيل.\n"
+                        "جرب اختيار مطعم أقرب أو المحاولة لاحقًا إن كانت هناك مشكلة لدى المطعم."
+                    ),
+                    parse_mode="Markdown"
+                )),
+                return_exceptions=True
             )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"❌ فشل أحد إشعارات رفض الطلب: {result}")
 
             logger.info(f"✅ تم رفض الطلب وإبلاغ المستخدم. (order_id={order_id})")
 
         except TelegramError as e:
             logger.error(f"❌ فشل في إرسال إشعار رفض الطلب: {e}")
         finally:
-            pending_orders.pop(order_id, None)  # 🧹 تنظيف الطلب
+            discard_pending_order(order_id)  # 🧹 تنظيف الطلب
 
     # ✅ زر الرجوع
     elif action == "back":
         try:
-            await query.edit_message_reply_markup(
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ قبول الطلب", callback_data=f"accept_{order_id}")],
-                    [InlineKeyboardButton("❌ رفض الطلب", callback_data=f"reject_{order_id}")],
-                    [InlineKeyboardButton("🚨 شكوى عن الزبون أو الطلب", callback_data=f"complain_{order_id}")]
-                ])
-            )
+            await query.edit_message_reply_markup(reply_markup=build_order_actions_kb(order_id))
         except TelegramError as e:
             logger.error(f"❌ فشل في عرض أزرار الرجوع: {e}")
 
     # ✅ عرض قائمة الشكاوى
     elif action == "complain":
         try:
-            await query.edit_message_reply_markup(
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🚪 وصل الديليفري ولم يجد الزبون", callback_data=f"report_delivery_{order_id}")],
-                    [InlineKeyboardButton("📞 رقم الهاتف غير صحيح", callback_data=f"report_phone_{order_id}")],
-                    [InlineKeyboardButton("📍 معلومات الموقع غير دقيقة", callback_data=f"report_location_{order_id}")],
-                    [InlineKeyboardButton("❓ مشكلة أخرى", callback_data=f"report_other_{order_id}")],
-                    [InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")]
-                ])
-            )
+            await query.edit_message_reply_markup(reply_markup=build_complaints_kb(order_id))
         except TelegramError as e:
             logger.error(f"❌ فشل في عرض أزرار الشكاوى: {e}")
 
@@ -340,44 +719,50 @@ async def button(update: Update, context: CallbackContext):
         reason_text = reason_map.get(report_type, "شكوى غير معروفة")
 
         try:
-            await context.bot.send_message(
-                chat_id=RESTAURANT_COMPLAINTS_CHAT_ID,
-                text=(
-                    f"📣 *شكوى من الكاشير على الطلب:*\n"
-                    f"📌 معرف الطلب: `{order_id}`\n"
-                    f"📍 السبب: {reason_text}\n\n"
-                    f"📝 *تفاصيل الطلب:*\n\n{order_details}"
+            # ✅ ثلاث وجهات مستقلة (قناة الشكاوى، القناة، رسالة الكاشير) — تُرسل بالتوازي
+            results = await asyncio.gather(
+                tg_send(context.bot.send_message(
+                    chat_id=RESTAURANT_COMPLAINTS_CHAT_ID,
+                    # ✅ تفاصيل الطلب نص من المستخدم قد يحوي رموز Markdown — تُرسل خامًا
+                    # حتى لا يفشل إرسال الشكوى نفسها بخطأ 400 من تيليغرام
+                    text=(
+                        f"📣 شكوى من الكاشير على الطلب:\n"
+                        f"📌 معرف الطلب: {order_id}\n"
+                        f"📍 السبب: {reason_text}\n\n"
+                        f"📝 تفاصيل الطلب:\n\n{order_details}"
+                    )
+                )),
+                tg_send(context.bot.send_message(
+                    chat_id=CHANNEL_ID,
+                    text=(
+                        f"🚫 تم إلغاء الطلب بسبب شكوى الكاشير.\n"
+                        f"📌 معرف الطلب: `{order_id}`\n"
+                        f"📍 السبب: {reason_text}"
+                    ),
+                    parse_mode="Markdown"
+                )),
+                context.bot.edit_message_reply_markup(
+                    chat_id=CASHIER_CHAT_ID,
+                    message_id=message_id,
+                    reply_markup=None
                 ),
-                parse_mode="Markdown"
+                return_exceptions=True
             )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"❌ فشل أحد إشعارات الشكوى: {result}")
 
-            await context.bot.send_message(
-                chat_id=CHANNEL_ID,
-                text=(
-                    f"🚫 تم إلغاء الطلب بسبب شكوى الكاشير.\n"
-                    f"📌 معرف الطلب: `{order_id}`\n"
-                    f"📍 السبب: {reason_text}"
-                ),
-                parse_mode="Markdown"
-            )
-
-            await context.bot.edit_message_reply_markup(
-                chat_id=CASHIER_CHAT_ID,
-                message_id=message_id,
-                reply_markup=None
-            )
-
-            await context.bot.send_message(
+            await tg_send(context.bot.send_message(
                 chat_id=CASHIER_CHAT_ID,
                 text="📨 تم إرسال الشكوى وإلغاء الطلب. سيتواصل معكم فريق الدعم إذا لزم الأمر."
-            )
+            ))
 
             logger.info(f"✅ تم إرسال شكوى بنجاح وتم تنظيف الطلب: {order_id}")
 
         except TelegramError as e:
             logger.error(f"❌ خطأ أثناء إرسال الشكوى: {e}")
         finally:
-            pending_orders.pop(order_id, None)  # 🧹 تنظيف الطلب
+            discard_pending_order(order_id)  # 🧹 تنظيف الطلب
 
 
 
@@ -391,17 +776,11 @@ async def handle_time_selection(update: Update, context: CallbackContext):
     # استخراج الوقت ومعرف الطلب
     _, time_selected, order_id = query.data.split("_")
 
-    # تحديث الأزرار مع إضافة زر "🚗 جاهز ليطلع"
-    keyboard = [
-        [InlineKeyboardButton(f"✅ {t} دقيقة" if str(t) == time_selected else f"{t} دقيقة", callback_data=f"time_{t}_{order_id}")]
-        for t in [5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 75, 90]
-    ]
-    keyboard.append([InlineKeyboardButton("🚗 جاهز ليطلع", callback_data=f"ready_{order_id}")])
-    keyboard.append([InlineKeyboardButton("🔙 رجوع", callback_data=f"back_{order_id}")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
+    # تحديث الأزرار مع تمييز الوقت المختار وإضافة زر "🚗 جاهز ليطلع"
     try:
-        await query.edit_message_reply_markup(reply_markup=reply_markup)
+        await query.edit_message_reply_markup(
+            reply_markup=build_time_kb(order_id, selected=time_selected, with_ready=True)
+        )
     except Exception as e:
         logger.warning(f"⚠️ لم يتم تحديث الأزرار: {e}")
 
@@ -411,35 +790,27 @@ async def handle_time_selection(update: Update, context: CallbackContext):
         logger.warning(f"⚠️ الطلب غير موجود في pending_orders: {order_id}")
         return
 
-    order_text = order_data["order_details"]
-
-    # استخراج البيانات
-    order_number_match = re.search(r"رقم الطلب[:\s]*([0-9]+)", order_text)
-    order_number = int(order_number_match.group(1)) if order_number_match else 0
-
-    total_price_match = re.search(r"المجموع الكلي[:\s]*([0-9,]+)", order_text)
-    total_price = int(total_price_match.group(1).replace(",", "")) if total_price_match else 0
+    # ✅ الحقول استُخرجت مسبقًا عند وصول الطلب — قراءة خصائص بدل إعادة تحليل النص
+    order_number = int(order_data.order_number) if order_data.order_number else 0
+    total_price = order_data.total_price
+    restaurant = order_data.restaurant
 
-    restaurant_match = re.search(r"المطعم[:\s]*(.+)", order_text)
-    restaurant = restaurant_match.group(1).strip() if restaurant_match else "غير معروف"
+    timestamp = int(time.time())
 
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # ✅ وضع الطلب في طابور الإدراج — المهمة الخلفية تكتبه ضمن دفعة واحدة
+    pending_inserts.append((order_id, order_number, restaurant, total_price, timestamp))
+    pending_inserts_event.set()
 
-    # ✅ تسجيل الطلب في قاعدة البيانات
-    try:
-        async with await aiosqlite.connect("restaurant_orders.db") as db:
-            await db.execute("""
-                INSERT INTO orders (order_id, order_number, restaurant, total_price, timestamp)
-                VALUES (?, ?, ?, ?, ?)
-            """, (order_id, order_number, restaurant, total_price, timestamp))
-            await db.commit()
-            logger.info(f"✅ تم تسجيل الطلب في قاعدة البيانات: {order_id}")
-    except Exception as e:
-        logger.error(f"❌ فشل تسجيل الطلب في قاعدة البيانات: {e}")
+    # ✅ ضغط رجعي: إذا تضخم الطابور (مثلاً تعطلت المهمة الخلفية) نكتبه فورًا
+    if len(pending_inserts) > PENDING_INSERTS_LIMIT:
+        await _flush_insert_batch(
+            context.application.bot_data["db"],
+            context.application.bot_data["db_lock"]
+        )
 
     # ✅ إرسال إشعار للمستخدم في القناة
     try:
-        await context.bot.send_message(
+        await tg_send(context.bot.send_message(
             chat_id=CHANNEL_ID,
             text=(
                 f"🔥 *الطلب عالنار بالمطبخ!* 🍽️\n\n"
@@ -447,7 +818,7 @@ async def handle_time_selection(update: Update, context: CallbackContext):
                 f"⏳ *مدة التحضير:* {time_selected} دقيقة"
             ),
             parse_mode="Markdown"
-        )
+        ))
     except Exception as e:
         logger.error(f"❌ فشل في إرسال إشعار القبول إلى القناة: {e}")
 
@@ -465,34 +836,16 @@ async def handle_channel_reminder(update: Update, context: CallbackContext):
     if "تذكير من الزبون" in message.text:
         logger.info(f"📥 استلم البوت تذكيرًا جديدًا: {message.text}")
         try:
-            await context.bot.send_message(
+            await tg_send(context.bot.send_message(
                 chat_id=CASHIER_CHAT_ID,
                 text=f"🔔 *تذكير من الزبون!*\n\n{message.text}",
                 parse_mode="Markdown"
-            )
+            ))
             logger.info("📩 تم إرسال التذكير إلى الكاشير بنجاح!")
         except Exception as e:
             logger.error(f"⚠️ خطأ أثناء إرسال التذكير إلى الكاشير: {e}")
 
 
-# 🔔 إعادة إرسال التذكير بصيغة أخرى
-async def handle_reminder_message(update: Update, context: CallbackContext):
-    message = update.channel_post
-    if not message or message.chat_id != CHANNEL_ID:
-        return
-
-    if "تذكير من الزبون" in message.text:
-        logger.info("📌 تم استلام تذكير من الزبون، إعادة توجيهه للكاشير...")
-        try:
-            await context.bot.send_message(
-                chat_id=CASHIER_CHAT_ID,
-                text=message.text
-            )
-            logger.info("✅ تم إرسال التذكير إلى الكاشير بنجاح.")
-        except Exception as e:
-            logger.error(f"❌ خطأ أثناء إرسال التذكير للكاشير: {e}")
-
-
 # ⏳ استفسار "كم يتبقى؟"
 async def handle_time_left_question(update: Update, context: CallbackContext):
     message = update.channel_post
@@ -502,11 +855,11 @@ async def handle_time_left_question(update: Update, context: CallbackContext):
     if "كم يتبقى" in message.text and "الطلب رقم" in message.text:
         logger.info("📥 تم استلام استفسار عن المدة المتبقية للطلب...")
         try:
-            await context.bot.send_message(
+            await tg_send(context.bot.send_message(
                 chat_id=CASHIER_CHAT_ID,
                 text=f"⏳ *استفسار من الزبون:*\n\n{message.text}",
                 parse_mode="Markdown"
-            )
+            ))
             logger.info("✅ تم إرسال الاستفسار إلى الكاشير بنجاح.")
         except Exception as e:
             logger.error(f"❌ خطأ أثناء إرسال الاستفسار للكاشير: {e}")
@@ -522,31 +875,35 @@ async def handle_rating_feedback(update: Update, context: CallbackContext):
     text = message.text or ""
     logger.info(f"📩 استلمنا إشعار تقييم من الزبون: {text}")
 
-    match = re.search(r"رقم (\d+)", text)
+    match = _RATING_NUM_RE.search(text)
     if not match:
         logger.warning("⚠️ لم يتم العثور على رقم الطلب في إشعار التقييم!")
         return
 
     order_number = match.group(1)
 
-    for order_id, data in pending_orders.items():
-        if f"رقم الطلب:* `{order_number}`" in data["order_details"]:
-            message_id = data.get("message_id")
-            if not message_id:
-                logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
-                return
-            try:
-                await context.bot.edit_message_reply_markup(
-                    chat_id=CASHIER_CHAT_ID,
-                    message_id=message_id,
-                    reply_markup=None
-                )
-                logger.info(f"✅ تم إزالة الأزرار من رسالة الطلب رقم: {order_number}")
-            except Exception as e:
-                logger.error(f"❌ فشل في إزالة الأزرار: {e}")
-            finally:
-                pending_orders.pop(order_id, None)  # 🧹 تنظيف الطلب بعد التقييم
-            break
+    # ✅ وصول مباشر عبر الفهرس الثانوي بدل المرور على كل الطلبات المعلقة
+    order_id = order_number_to_id.get(order_number)
+    data = pending_orders.get(order_id) if order_id else None
+    if not data:
+        return
+
+    message_id = data.message_id
+    if not message_id:
+        logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
+        return
+
+    try:
+        await context.bot.edit_message_reply_markup(
+            chat_id=CASHIER_CHAT_ID,
+            message_id=message_id,
+            reply_markup=None
+        )
+        logger.info(f"✅ تم إزالة الأزرار من رسالة الطلب رقم: {order_number}")
+    except Exception as e:
+        logger.error(f"❌ فشل في إزالة الأزرار: {e}")
+    finally:
+        discard_pending_order(order_id)  # 🧹 تنظيف الطلب بعد التقييم
 
 
 
@@ -564,10 +921,10 @@ async def handle_order_delivered_rating(update: Update, context: CallbackContext
         logger.info("ℹ️ تم تجاهل رسالة التقييم، ليست كاملة.")
         return
 
-    order_number_match = re.search(r"طلبه رقم\s*(\d+)", text)
+    order_number_match = _DELIVERED_NUM_RE.search(text)
     order_number = order_number_match.group(1) if order_number_match else None
 
-    order_id_match = re.search(r"معرف الطلب:\s*(\w+)", text)
+    order_id_match = _DELIVERED_ID_RE.search(text)
     order_id = order_id_match.group(1) if order_id_match else None
 
     if not order_number or not order_id:
@@ -581,7 +938,7 @@ async def handle_order_delivered_rating(update: Update, context: CallbackContext
         logger.warning(f"⚠️ لم يتم العثور على الطلب بمعرف: {order_id}")
         return
 
-    message_id = order_data.get("message_id")
+    message_id = order_data.message_id
     if not message_id:
         logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
         return
@@ -596,15 +953,15 @@ async def handle_order_delivered_rating(update: Update, context: CallbackContext
 
         stars = extract_stars(text)
 
-        await context.bot.send_message(
+        await tg_send(context.bot.send_message(
             chat_id=CASHIER_CHAT_ID,
             text=f"✅ الزبون استلم طلبه رقم {order_number} وقام بتقييمه بـ {stars}"
-        )
+        ))
 
     except Exception as e:
         logger.error(f"❌ خطأ أثناء إزالة الأزرار أو إرسال إشعار: {e}")
     finally:
-        pending_orders.pop(order_id, None)
+        discard_pending_order(order_id)
 
 
 # ✅ استلام إلغاء الطلب من الزبون
@@ -616,10 +973,10 @@ async def handle_report_cancellation_notice(update: Update, context: CallbackCon
     text = message.text or ""
     logger.info(f"📩 تم استلام إشعار إلغاء مع تقرير: {text}")
 
-    order_number_match = re.search(r"إلغاء الطلب رقم[:\s]*(\d+)", text)
+    order_number_match = _CANCEL_NUM_RE.search(text)
     order_number = order_number_match.group(1) if order_number_match else None
 
-    order_id_match = re.search(r"معرف الطلب[:\s]*`?([\w\d]+)`?", text)
+    order_id_match = _CANCEL_ID_RE.search(text)
     order_id = order_id_match.group(1) if order_id_match else None
 
     if not order_number or not order_id:
@@ -631,7 +988,7 @@ async def handle_report_cancellation_notice(update: Update, context: CallbackCon
         logger.warning(f"⚠️ الطلب غير موجود في pending_orders: {order_id}")
         return
 
-    message_id = order_data.get("message_id")
+    message_id = order_data.message_id
     if not message_id:
         logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
         return
@@ -644,7 +1001,7 @@ async def handle_report_cancellation_notice(update: Update, context: CallbackCon
         )
         logger.info(f"✅ تم إزالة أزرار الطلب رقم {order_number} (معرف: {order_id})")
 
-        await context.bot.send_message(
+        await tg_send(context.bot.send_message(
             chat_id=CASHIER_CHAT_ID,
             text=(
                 f"🚫 تم إلغاء الطلب رقم {order_number} من قبل الزبون.\n"
@@ -653,11 +1010,11 @@ async def handle_report_cancellation_notice(update: Update, context: CallbackCon
                 f"📞 يمكنكم التواصل مع الزبون عبر رقم الهاتف المرفق في الطلب."
             ),
             parse_mode="Markdown"
-        )
+        ))
     except Exception as e:
         logger.error(f"❌ خطأ أثناء معالجة إلغاء مع تقرير: {e}")
     finally:
-        pending_orders.pop(order_id, None)
+        discard_pending_order(order_id)
 
 
 # ✅ استلام إلغاء الطلب من الزبون
@@ -669,10 +1026,10 @@ async def handle_standard_cancellation_notice(update: Update, context: CallbackC
     text = message.text or ""
     logger.info(f"📩 تم استلام إشعار إلغاء عادي: {text}")
 
-    order_number_match = re.search(r"إلغاء الطلب رقم[:\s]*(\d+)", text)
+    order_number_match = _CANCEL_NUM_RE.search(text)
     order_number = order_number_match.group(1) if order_number_match else None
 
-    order_id_match = re.search(r"معرف الطلب[:\s]*`?([\w\d]+)`?", text)
+    order_id_match = _CANCEL_ID_RE.search(text)
     order_id = order_id_match.group(1) if order_id_match else None
 
     if not order_number or not order_id:
@@ -684,7 +1041,7 @@ async def handle_standard_cancellation_notice(update: Update, context: CallbackC
         logger.warning(f"⚠️ الطلب غير موجود في pending_orders: {order_id}")
         return
 
-    message_id = order_data.get("message_id")
+    message_id = order_data.message_id
     if not message_id:
         logger.warning(f"⚠️ لا يوجد message_id محفوظ للطلب: {order_id}")
         return
@@ -697,7 +1054,7 @@ async def handle_standard_cancellation_notice(update: Update, context: CallbackC
         )
         logger.info(f"✅ تم إزالة أزرار الطلب رقم {order_number} (معرف: {order_id})")
 
-        await context.bot.send_message(
+        await tg_send(context.bot.send_message(
             chat_id=CASHIER_CHAT_ID,
             text=(
                 f"🚫 تم إلغاء الطلب رقم {order_number} من قبل الزبون.\n"
@@ -705,19 +1062,122 @@ async def handle_standard_cancellation_notice(update: Update, context: CallbackC
                 f"📍 السبب: تردد الزبون وقرر الإلغاء."
             ),
             parse_mode="Markdown"
-        )
+        ))
 
     except Exception as e:
         logger.error(f"❌ خطأ أثناء معالجة الإلغاء العادي: {e}")
     finally:
-        pending_orders.pop(order_id, None)
+        discard_pending_order(order_id)
+
+
+# ✅ كلمات التصنيف مجموعة في تناوب واحد مترجم: مسح واحد للنص يحدد نوع الرسالة
+# بدل عدة بحوث جزئية متتالية لكل كلمة مفتاحية
+_CHANNEL_ROUTE_RE = re.compile(
+    r"(?P<delivered>استلم طلبه رقم)"
+    r"|(?P<cancel>إلغاء الطلب رقم)"
+    r"|(?P<timeleft>كم يتبقى)"
+    r"|(?P<remind>تذكير من الزبون)"
+    r"|(?P<order>معرف الطلب)"
+)
+
+
+# ✅ معالجات فرعية لكل مسار — الفروق الدقيقة داخل المسار الواحد تبقى محلية هنا
+async def _route_delivered(update, context, text):
+    if "قام بتقييمه بـ" in text:
+        if "معرف الطلب" in text:
+            await handle_order_delivered_rating(update, context)
+        else:
+            await handle_rating_feedback(update, context)
+    elif "معرف الطلب" in text:
+        await handle_channel_order(update, context)
+
+
+async def _route_cancel(update, context, text):
+    if "تأخر المطعم" in text and "تم إنشاء تقرير" in text:
+        await handle_report_cancellation_notice(update, context)
+    else:
+        await handle_standard_cancellation_notice(update, context)
+
+
+async def _route_timeleft(update, context, text):
+    if "الطلب رقم" in text:
+        await handle_time_left_question(update, context)
+
+
+async def _route_remind(update, context, text):
+    await handle_channel_reminder(update, context)
+
+
+async def _route_order(update, context, text):
+    await handle_channel_order(update, context)
+
+
+# ✅ اسم المجموعة في التناوب → معالج المسار: قفزة قاموس بدل سلسلة مقارنات
+_CHANNEL_ROUTES = {
+    "delivered": _route_delivered,
+    "cancel": _route_cancel,
+    "timeleft": _route_timeleft,
+    "remind": _route_remind,
+    "order": _route_order,
+}
+
+
+# ✅ موزّع رسائل القناة: تصنيف النص بمسح واحد ثم استدعاء المعالج المناسب
+async def handle_channel_message(update: Update, context: CallbackContext):
+    message = update.channel_post
+    if not message or message.chat_id != CHANNEL_ID or not message.text:
+        return
+
+    text = message.text
+    match = _CHANNEL_ROUTE_RE.search(text)
+    if not match:
+        return
+
+    await _CHANNEL_ROUTES[match.lastgroup](update, context, text)
+
+
+# ✅ إدراج دفعة من الدليفري في معاملة واحدة (BEGIN IMMEDIATE + executemany)
+# الإضافة المفردة تمر من هنا أيضًا، وأي استيراد جماعي مستقبلي يمرر كل الصفوف دفعة واحدة
+async def insert_delivery_persons(db, db_lock, rows):
+    async with db_lock:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            await db.executemany(
+                "INSERT INTO delivery_persons (restaurant, name, phone) VALUES (?, ?, ?)",
+                rows
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
+
+# ✅ لوحات المفاتيح الثابتة تُبنى مرة واحدة عند تحميل الوحدة بدل إعادة إنشائها في كل رسالة
+DELIVERY_MENU_KB = ReplyKeyboardMarkup(
+    [["➕ إضافة دليفري", "❌ حذف دليفري"], ["🔙 رجوع"]], resize_keyboard=True
+)
+BACK_KB = ReplyKeyboardMarkup([["🔙 رجوع"]], resize_keyboard=True)
+
+# ✅ القائمة الرئيسية للمشرف: أزرار الإحصائيات وإدارة الدليفري
+ADMIN_MAIN_MENU_KB = ReplyKeyboardMarkup(
+    [
+        ["📊 عدد الطلبات اليوم والدخل", "📅 عدد الطلبات أمس والدخل"],
+        ["🗓️ طلبات الشهر الحالي", "📆 طلبات الشهر الماضي"],
+        ["📈 طلبات السنة الحالية", "📉 طلبات السنة الماضية"],
+        ["📋 إجمالي الطلبات والدخل", "🚚 الدليفري"],
+    ],
+    resize_keyboard=True
+)
+
+
+def get_admin_main_menu():
+    return ADMIN_MAIN_MENU_KB
 
 
 async def handle_delivery_menu(update: Update, context: CallbackContext):
-    reply_keyboard = [["➕ إضافة دليفري", "❌ حذف دليفري"], ["🔙 رجوع"]]
     await update.message.reply_text(
         "📦 إدارة الدليفري:\nاختر الإجراء المطلوب:",
-        reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
+        reply_markup=DELIVERY_MENU_KB
     )
     context.user_data["delivery_action"] = "menu"
 
@@ -728,8 +1188,7 @@ async def handle_add_delivery(update: Update, context: CallbackContext):
     if text == "🔙 رجوع":
         context.user_data.pop("delivery_action", None)
         context.user_data.pop("new_delivery_name", None)
-        reply_keyboard = [["➕ إضافة دليفري", "❌ حذف دليفري"], ["🔙 رجوع"]]
-        await update.message.reply_text("⬅️ تم الرجوع إلى قائمة الدليفري.", reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True))
+        await update.message.reply_text("⬅️ تم الرجوع إلى قائمة الدليفري.", reply_markup=DELIVERY_MENU_KB)
         return
 
     action = context.user_data.get("delivery_action")
@@ -738,7 +1197,7 @@ async def handle_add_delivery(update: Update, context: CallbackContext):
     if action == "adding_name":
         context.user_data["new_delivery_name"] = text
         context.user_data["delivery_action"] = "adding_phone"
-        await update.message.reply_text("📞 ما رقم الهاتف؟", reply_markup=ReplyKeyboardMarkup([["🔙 رجوع"]], resize_keyboard=True))
+        await update.message.reply_text("📞 ما رقم الهاتف؟", reply_markup=BACK_KB)
 
     # ☎️ المرحلة 2: استلام الرقم وحفظ البيانات
     elif action == "adding_phone":
@@ -747,21 +1206,19 @@ async def handle_add_delivery(update: Update, context: CallbackContext):
         restaurant_name = context.user_data.get("restaurant")  # تأكد أنه مخزن مسبقًا
 
         try:
-            async with await get_db_connection() as db:
-                await db.execute(
-                    "INSERT INTO delivery_persons (restaurant, name, phone) VALUES (?, ?, ?)",
-                    (restaurant_name, name, phone)
-                )
-                await db.commit()
+            await insert_delivery_persons(
+                context.application.bot_data["db"],
+                context.application.bot_data["db_lock"],
+                [(restaurant_name, name, phone)]
+            )
 
             # ✅ إنهاء العملية
             context.user_data.pop("delivery_action", None)
             context.user_data.pop("new_delivery_name", None)
 
-            reply_keyboard = [["➕ إضافة دليفري", "❌ حذف دليفري"], ["🔙 رجوع"]]
             await update.message.reply_text(
                 f"✅ تم إضافة الدليفري:\n🧑‍💼 {name}\n📞 {phone}",
-                reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
+                reply_markup=DELIVERY_MENU_KB
             )
 
         except Exception as e:
@@ -770,22 +1227,20 @@ async def handle_add_delivery(update: Update, context: CallbackContext):
 
 async def ask_add_delivery_name(update: Update, context: CallbackContext):
     context.user_data["delivery_action"] = "adding_name"
-    await update.message.reply_text("🧑‍💼 ما اسم الدليفري؟", reply_markup=ReplyKeyboardMarkup([["🔙 رجوع"]], resize_keyboard=True))
+    await update.message.reply_text("🧑‍💼 ما اسم الدليفري؟", reply_markup=BACK_KB)
 
 async def handle_delete_delivery_menu(update: Update, context: CallbackContext):
     restaurant_name = context.user_data.get("restaurant")
 
     try:
-        async with await get_db_connection() as db:
-            async with db.execute(
-                "SELECT name FROM delivery_persons WHERE restaurant = ?", (restaurant_name,)
-            ) as cursor:
-                rows = await cursor.fetchall()
+        db = context.application.bot_data["db"]
+        async with db.execute(
+            "SELECT name FROM delivery_persons WHERE restaurant = ?", (restaurant_name,)
+        ) as cursor:
+            rows = await cursor.fetchall()
 
         if not rows:
-            await update.message.reply_text("⚠️ لا يوجد أي دليفري مسجل حالياً.", reply_markup=ReplyKeyboardMarkup(
-                [["➕ إضافة دليفري", "❌ حذف دليفري"], ["🔙 رجوع"]], resize_keyboard=True
-            ))
+            await update.message.reply_text("⚠️ لا يوجد أي دليفري مسجل حالياً.", reply_markup=DELIVERY_MENU_KB)
             return
 
         names = [row[0] for row in rows]
@@ -800,14 +1255,23 @@ async def handle_delete_delivery_menu(update: Update, context: CallbackContext):
         await update.message.reply_text("⚠️ حدث خطأ أثناء عرض القائمة.")
 
 
+# ✅ موزّع واحد للنصوص الحرة — يوجّه حسب حالة الحوار المخزنة في user_data
+# بدل معالجين شاملين يُستدعى أولهما دائمًا لكل رسالة نصية
+async def handle_delivery_text(update: Update, context: CallbackContext):
+    action = context.user_data.get("delivery_action")
+    if action == "deleting":
+        await handle_delete_delivery_choice(update, context)
+    elif action in ("adding_name", "adding_phone") or update.message.text == "🔙 رجوع":
+        await handle_add_delivery(update, context)
+
+
 async def handle_delete_delivery_choice(update: Update, context: CallbackContext):
     text = update.message.text
 
     # الرجوع
     if text == "🔙 رجوع":
         context.user_data.pop("delivery_action", None)
-        reply_keyboard = [["➕ إضافة دليفري", "❌ حذف دليفري"], ["🔙 رجوع"]]
-        await update.message.reply_text("⬅️ تم الرجوع إلى قائمة الدليفري.", reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True))
+        await update.message.reply_text("⬅️ تم الرجوع إلى قائمة الدليفري.", reply_markup=DELIVERY_MENU_KB)
         return
 
     if context.user_data.get("delivery_action") != "deleting":
@@ -816,19 +1280,22 @@ async def handle_delete_delivery_choice(update: Update, context: CallbackContext
     restaurant_name = context.user_data.get("restaurant")
 
     try:
-        async with await get_db_connection() as db:
-            await db.execute(
-                "DELETE FROM delivery_persons WHERE restaurant = ? AND name = ?",
-                (restaurant_name, text)
-            )
-            await db.commit()
+        db = context.application.bot_data["db"]
+        async with context.application.bot_data["db_lock"]:
+            # ✅ BEGIN IMMEDIATE يحجز قفل الكتابة مباشرة فيتم الحذف والتثبيت في مزامنة واحدة
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                await db.execute(DELETE_DELIVERY_SQL, (restaurant_name, text))
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
 
         context.user_data.pop("delivery_action", None)
 
-        reply_keyboard = [["➕ إضافة دليفري", "❌ حذف دليفري"], ["🔙 رجوع"]]
         await update.message.reply_text(
             f"✅ تم حذف الدليفري: {text}",
-            reply_markup=ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
+            reply_markup=DELIVERY_MENU_KB
         )
 
     except Exception as e:
@@ -838,189 +1305,189 @@ async def handle_delete_delivery_choice(update: Update, context: CallbackContext
 
 
 
-async def handle_today_stats(update: Update, context: CallbackContext):
-    today = datetime.datetime.now().strftime('%Y-%m-%d')
+# ✅ كاش بدقة دقيقة لتاريخ اليوم — ضغطات الإحصائيات المتتالية لا تعيد حساب now()
+_today_cache = (0, None)
 
-    try:
-        async with aiosqlite.connect("restaurant_orders.db") as db:
-            async with db.execute("""
-                SELECT COUNT(*), SUM(total_price) 
-                FROM orders 
-                WHERE DATE(timestamp) = ?
-            """, (today,)) as cursor:
-                result = await cursor.fetchone()
 
-        count = result[0] or 0
-        total = result[1] or 0
+def today_date():
+    global _today_cache
+    bucket = int(time.time()) // 60
+    if bucket != _today_cache[0]:
+        _today_cache = (bucket, datetime.date.today())
+    return _today_cache[1]
 
-        await update.message.reply_text(
-            f"📊 *إحصائيات اليوم*\n\n"
-            f"🔢 عدد الطلبات: *{count}*\n"
-            f"💰 الدخل الكلي: *{total}* ل.س",
-            parse_mode="Markdown"
-        )
-    except Exception as e:
-        logger.error(f"❌ فشل استخراج إحصائيات اليوم: {e}")
 
-async def handle_yesterday_stats(update: Update, context: CallbackContext):
-    yesterday = (datetime.datetime.now() - datetime.timedelta(days=1)).date()
+# ✅ حدود كل فترة إحصائية: ترجع (بداية، نهاية، عنوان) — النهاية حد مفتوح [start, end)
+def _bounds_today():
+    today = today_date()
+    return today.isoformat(), (today + datetime.timedelta(days=1)).isoformat(), "📊 *إحصائيات اليوم*"
 
-    try:
-        async with aiosqlite.connect("restaurant_orders.db") as db:
-            async with db.execute("""
-                SELECT COUNT(*), SUM(total_price) 
-                FROM orders 
-                WHERE DATE(timestamp) = ?
-            """, (yesterday.isoformat(),)) as cursor:
-                result = await cursor.fetchone()
 
-        count = result[0] or 0
-        total = result[1] or 0
+def _bounds_yesterday():
+    today = today_date()
+    return (today - datetime.timedelta(days=1)).isoformat(), today.isoformat(), "📅 *إحصائيات يوم أمس:*"
 
-        await update.message.reply_text(
-            f"📅 *إحصائيات يوم أمس:*\n\n"
-            f"🔢 عدد الطلبات: {count}\n"
-            f"💰 الدخل الكلي: {total} ل.س",
-            parse_mode="Markdown"
-        )
-    except Exception as e:
-        logger.error(f"❌ فشل استخراج إحصائيات أمس: {e}")
 
+def _bounds_current_month():
+    today = today_date()
+    return today.replace(day=1).isoformat(), (today + datetime.timedelta(days=1)).isoformat(), "🗓️ *إحصائيات الشهر الحالي:*"
 
-async def handle_current_month_stats(update: Update, context: CallbackContext):
-    today = datetime.datetime.now()
-    first_day = today.replace(day=1).date().isoformat()
-    last_day = today.date().isoformat()
 
-    try:
-        async with aiosqlite.connect("restaurant_orders.db") as db:
-            async with db.execute("""
-                SELECT COUNT(*), SUM(total_price)
-                FROM orders
-                WHERE DATE(timestamp) BETWEEN ? AND ?
-            """, (first_day, last_day)) as cursor:
-                result = await cursor.fetchone()
+def _bounds_last_month():
+    first_day_this_month = today_date().replace(day=1)
+    last_day_last_month = first_day_this_month - datetime.timedelta(days=1)
+    return last_day_last_month.replace(day=1).isoformat(), first_day_this_month.isoformat(), "📆 *إحصائيات الشهر الماضي:*"
 
-        count = result[0] or 0
-        total = result[1] or 0
 
-        await update.message.reply_text(
-            f"🗓️ *إحصائيات الشهر الحالي:*\n\n"
-            f"🔢 عدد الطلبات: {count}\n"
-            f"💰 الدخل الكلي: {total} ل.س",
-            parse_mode="Markdown"
-        )
-    except Exception as e:
-        logger.error(f"❌ خطأ أثناء استخراج إحصائيات الشهر الحالي: {e}")
+def _bounds_current_year():
+    today = today_date()
+    return today.replace(month=1, day=1).isoformat(), (today + datetime.timedelta(days=1)).isoformat(), "📈 *إحصائيات السنة الحالية:*"
 
-async def handle_last_month_stats(update: Update, context: CallbackContext):
-    today = datetime.datetime.now()
-    first_day_this_month = today.replace(day=1)
-    last_day_last_month = first_day_this_month - datetime.timedelta(days=1)
-    first_day_last_month = last_day_last_month.replace(day=1)
 
-    start_date = first_day_last_month.date().isoformat()
-    end_date = last_day_last_month.date().isoformat()
+def _bounds_last_year():
+    last_year = today_date().year - 1
+    return f"{last_year}-01-01", f"{last_year + 1}-01-01", f"📉 *إحصائيات السنة الماضية ({last_year}):*"
 
-    try:
-        async with aiosqlite.connect("restaurant_orders.db") as db:
-            async with db.execute("""
-                SELECT COUNT(*), SUM(total_price)
-                FROM orders
-                WHERE DATE(timestamp) BETWEEN ? AND ?
-            """, (start_date, end_date)) as cursor:
-                result = await cursor.fetchone()
 
-        count = result[0] or 0
-        total = result[1] or 0
+def _bounds_total():
+    return None, None, "📋 *إجمالي الإحصائيات:*"
 
-        await update.message.reply_text(
-            f"📆 *إحصائيات الشهر الماضي:*\n\n"
-            f"🔢 عدد الطلبات: {count}\n"
-            f"💰 الدخل الكلي: {total} ل.س",
-            parse_mode="Markdown"
-        )
-    except Exception as e:
-        logger.error(f"❌ خطأ أثناء استخراج إحصائيات الشهر الماضي: {e}")
 
-async def handle_current_year_stats(update: Update, context: CallbackContext):
-    today = datetime.datetime.now()
-    start_date = today.replace(month=1, day=1).date().isoformat()
-    end_date = today.date().isoformat()
+# ✅ الفترات في جدول واحد: (نص زر القائمة، دالة الحدود، مدة الكاش) — معالج واحد للجميع
+PERIODS = {
+    "today": ("📊 عدد الطلبات اليوم والدخل", _bounds_today, STATS_TTL_CURRENT),
+    "yesterday": ("📅 عدد الطلبات أمس والدخل", _bounds_yesterday, STATS_TTL_PAST),
+    "month": ("🗓️ طلبات الشهر الحالي", _bounds_current_month, STATS_TTL_CURRENT),
+    "last_month": ("📆 طلبات الشهر الماضي", _bounds_last_month, STATS_TTL_PAST),
+    "year": ("📈 طلبات السنة الحالية", _bounds_current_year, STATS_TTL_CURRENT),
+    "last_year": ("📉 طلبات السنة الماضية", _bounds_last_year, None),
+    "total": ("📋 إجمالي الطلبات والدخل", _bounds_total, STATS_TTL_CURRENT),
+}
 
-    try:
-        async with aiosqlite.connect("restaurant_orders.db") as db:
-            async with db.execute("""
-                SELECT COUNT(*), SUM(total_price)
-                FROM orders
-                WHERE DATE(timestamp) BETWEEN ? AND ?
-            """, (start_date, end_date)) as cursor:
-                result = await cursor.fetchone()
 
-        count = result[0] or 0
-        total = result[1] or 0
+# ✅ مجاميع سنة مقفلة: تُقرأ من yearly_totals، وعند أول طلب تُحسب من daily_stats وتُحفظ
+async def get_closed_year_totals(db, db_lock, year):
+    async with db.execute(YEARLY_TOTALS_SQL, (year,)) as cursor:
+        row = await cursor.fetchone()
+    if row is not None:
+        return row
 
-        await update.message.reply_text(
-            f"📈 *إحصائيات السنة الحالية:*\n\n"
-            f"🔢 عدد الطلبات: {count}\n"
-            f"💰 الدخل الكلي: {total} ل.س",
-            parse_mode="Markdown"
-        )
-    except Exception as e:
-        logger.error(f"❌ خطأ أثناء استخراج إحصائيات السنة الحالية: {e}")
+    async with db.execute(STATS_RANGE_SQL, (f"{year}-01-01", f"{year + 1}-01-01")) as cursor:
+        row = await cursor.fetchone()
 
+    # ✅ صف فارغ قد يعني أن المجاميع اليومية لم تُعبّأ بعد — لا نخلّد أصفارًا في الجدول
+    if row[0] == 0:
+        return row
 
-async def handle_last_year_stats(update: Update, context: CallbackContext):
-    today = datetime.datetime.now()
-    last_year = today.year - 1
-    start_date = f"{last_year}-01-01"
-    end_date = f"{last_year}-12-31"
+    async with db_lock:
+        await db.execute(UPSERT_YEARLY_SQL, (year, row[0], row[1]))
+        await db.commit()
+    return row
 
-    try:
-        async with aiosqlite.connect("restaurant_orders.db") as db:
-            async with db.execute("""
-                SELECT COUNT(*), SUM(total_price)
-                FROM orders
-                WHERE DATE(timestamp) BETWEEN ? AND ?
-            """, (start_date, end_date)) as cursor:
-                result = await cursor.fetchone()
 
-        count = result[0] or 0
-        total = result[1] or 0
+# ✅ الإجمالي الكلي = مجموع السنوات المقفلة المحفوظة + الجزء الجاري من السنة الحالية
+async def get_total_stats(db, db_lock):
+    current_year = today_date().year
 
-        await update.message.reply_text(
-            f"📉 *إحصائيات السنة الماضية ({last_year}):*\n\n"
-            f"🔢 عدد الطلبات: {count}\n"
-            f"💰 الدخل الكلي: {total} ل.س",
-            parse_mode="Markdown"
-        )
-    except Exception as e:
-        logger.error(f"❌ خطأ أثناء استخراج إحصائيات السنة الماضية: {e}")
+    # ✅ ترحيل أي سنة مقفلة ما تزال في daily_stats فقط إلى yearly_totals
+    async with db.execute(
+        "SELECT DISTINCT CAST(substr(day, 1, 4) AS INTEGER) FROM daily_stats WHERE day < ?",
+        (f"{current_year}-01-01",)
+    ) as cursor:
+        closed_years = [row[0] for row in await cursor.fetchall()]
+    for year in closed_years:
+        await get_closed_year_totals(db, db_lock, year)
 
-async def handle_total_stats(update: Update, context: CallbackContext):
-    try:
-        async with aiosqlite.connect("restaurant_orders.db") as db:
-            async with db.execute("SELECT COUNT(*), SUM(total_price) FROM orders") as cursor:
-                result = await cursor.fetchone()
+    async with db.execute(CLOSED_YEARS_SUM_SQL, (current_year,)) as cursor:
+        closed = await cursor.fetchone()
+    async with db.execute(
+        STATS_RANGE_SQL, (f"{current_year}-01-01", f"{current_year + 1}-01-01")
+    ) as cursor:
+        partial = await cursor.fetchone()
+    return closed[0] + partial[0], closed[1] + partial[1]
 
-        count = result[0] or 0
-        total = result[1] or 0
 
-        await update.message.reply_text(
-            f"📋 *إجمالي الإحصائيات:*\n\n"
-            f"🔢 عدد كل الطلبات: {count}\n"
-            f"💰 مجموع الدخل: {total} ل.س",
-            parse_mode="Markdown"
-        )
+# ✅ قالب الرد يُجهّز مرة واحدة عند تحميل الوحدة — الاستدعاء مجرد تعبئة خانات
+STATS_BODY_TMPL = "{title}\n\n🔢 عدد الطلبات: {c}\n💰 الدخل الكلي: {t} ل.س".format
+STATS_EMPTY_SUFFIX = "\n\nلا توجد طلبات مسجلة في هذه الفترة."
+
+
+async def handle_period_stats(update: Update, context: CallbackContext, period: str):
+    _, bounds_fn, ttl = PERIODS[period]
+    start, end, title = bounds_fn()
+
+    try:
+        cache_key = f"{period}:{start}:{end}"
+        result = _stats_cache_get(cache_key, ttl)
+        if result is None:
+            db = context.application.bot_data["db"]
+            db_lock = context.application.bot_data["db_lock"]
+            if period == "total":
+                result = await get_total_stats(db, db_lock)
+            elif period == "last_year":
+                result = await get_closed_year_totals(db, db_lock, today_date().year - 1)
+            else:
+                # ✅ القراءات الصرفة تمر عبر اتصال القراءة فلا تنتظر قفل الكاتب
+                db_read = context.application.bot_data.get("db_read", db)
+                async with db_read.execute(STATS_RANGE_SQL, (start, end)) as cursor:
+                    result = await cursor.fetchone()
+            # ✅ نتيجة فارغة لسنة مقفلة لا تُخلَّد في الكاش — قد تسبق تعبئة المجاميع
+            if not (period == "last_year" and result[0] == 0):
+                _stats_cache_put(cache_key, result)
+
+        count, total = result
+
+        # ✅ مسار سريع للفترات الفارغة: نص عادي بلا parse_mode فلا يُحلّل أي Markdown
+        if count == 0:
+            text = title.replace("*", "") + STATS_EMPTY_SUFFIX
+            parse_mode = None
+        else:
+            text = STATS_BODY_TMPL(title=title, c=count, t=total)
+            parse_mode = "Markdown"
+
+        # ✅ تحرير لوحة الإحصائيات المثبتة بدل إرسال رسالة جديدة عند كل ضغطة
+        stats_msg_id = context.chat_data.get("stats_msg_id")
+        if stats_msg_id:
+            try:
+                await context.bot.edit_message_text(
+                    chat_id=update.effective_chat.id,
+                    message_id=stats_msg_id,
+                    text=text,
+                    parse_mode=parse_mode
+                )
+                return
+            except TelegramError as e:
+                # ✅ نفس النص دون تغيير أو لوحة محذوفة — نعود للإرسال العادي
+                logger.debug(f"ℹ️ تعذّر تحرير لوحة الإحصائيات: {e}")
+
+        await update.message.reply_text(text, parse_mode=parse_mode)
     except Exception as e:
-        logger.error(f"❌ خطأ أثناء استخراج إجمالي الإحصائيات: {e}")
+        logger.error(f"❌ فشل استخراج الإحصائيات ({period}): {e}")
 
 
-async def error_handler(update: object, context: CallbackContext) -> None:
-    logger.error(msg="🚨 حدث استثناء أثناء معالجة التفاعل:", exc_info=context.error)
+# ✅ نص زر القائمة → اسم الفترة: بحث O(1) بدل مطابقة كل نمط على حدة
+STATS_LABELS = {label: period for period, (label, _, _) in PERIODS.items()}
 
-    traceback_str = ''.join(traceback.format_exception(None, context.error, context.error.__traceback__))
-    print("⚠️ تفاصيل الخطأ:\n", traceback_str)
+
+async def dispatch_stats(update: Update, context: CallbackContext):
+    await handle_period_stats(update, context, STATS_LABELS[update.message.text])
+
+
+# ✅ كبح الأخطاء المتكررة: نفس نوع الخطأ يُسجّل بكامل تفاصيله مرة واحدة في كل نافذة زمنية
+_error_log_buckets = {}
+ERROR_LOG_WINDOW = 60  # ثانية
+
+
+async def error_handler(update: object, context: CallbackContext) -> None:
+    # ✅ تسجيل واحد عبر logger (التنسيق يتم في الخيط الخلفي) بدل التسجيل المزدوج مع print
+    error_key = type(context.error).__name__
+    now = time.monotonic()
+    last = _error_log_buckets.get(error_key)
+    if last is None or now - last >= ERROR_LOG_WINDOW:
+        _error_log_buckets[error_key] = now
+        logger.error("🚨 حدث استثناء أثناء معالجة التفاعل:", exc_info=context.error)
+    else:
+        logger.error(f"🚨 استثناء متكرر ({error_key}) — التفاصيل سُجّلت سابقًا خلال هذه النافذة.")
 
     try:
         if update and hasattr(update, 'callback_query') and update.callback_query.message:
@@ -1030,87 +1497,96 @@ async def error_handler(update: object, context: CallbackContext) -> None:
 
 
 
+# ✅ يُستدعى داخل الـ loop الذي ينشئه run_polling: فتح قاعدة البيانات وتشغيل مهام الخلفية
+async def post_init(application):
+    db = await initialize_database()
+
+    # ✅ مشاركة الاتصال الدائم مع كل المعالجات عبر bot_data
+    application.bot_data["db"] = db
+    application.bot_data["db_lock"] = asyncio.Lock()
+
+    # ✅ اتصال قراءة مخصص للإحصائيات: query_only لا يحجز مقبض معاملة قابلة للكتابة
+    # فلا تتزاحم قراءات الإحصائيات مع كاتب الدفعات على نفس الاتصال
+    db_read = await get_db_connection()
+    if db_read is not None:
+        await db_read.execute("PRAGMA busy_timeout=5000")
+        await db_read.execute("PRAGMA query_only=ON")
+    application.bot_data["db_read"] = db_read or db
+
+    # ✅ مهام الخلفية: كتابة دفعات الطلبات + تنظيف الطلبات المتروكة
+    application.bot_data["bg_tasks"] = [
+        asyncio.create_task(flush_pending_inserts(application)),
+        asyncio.create_task(sweep_pending_orders()),
+    ]
+
+
 # ✅ **إعداد البوت وتشغيله**
-async def run_bot():
+def run_bot():
     # ✅ تحميل إعدادات المطعم من ملف JSON
     config = load_config()
 
-    global TOKEN, CASHIER_CHAT_ID, CHANNEL_ID, RESTAURANT_COMPLAINTS_CHAT_ID
+    global TOKEN, CASHIER_CHAT_ID, CHANNEL_ID, RESTAURANT_COMPLAINTS_CHAT_ID, DB_NETWORK_MODE
     TOKEN = config["token"]
     CASHIER_CHAT_ID = int(config["cashier_id"])
     CHANNEL_ID = int(config["channel_id"])
     RESTAURANT_COMPLAINTS_CHAT_ID = int(config.get("complaints_channel_id", CHANNEL_ID))  # fallback
-
-    # ✅ بناء التطبيق بالتوكن المحمّل
-    app = Application.builder().token(TOKEN).build()
-
-    # ✅ إنشاء قاعدة البيانات
-    await initialize_database()
+    DB_NETWORK_MODE = bool(config.get("db_network_mode", False))
+
+    # ✅ تجمع اتصالات أكبر مع HTTP/2 حتى لا تتسلسل الإرسالات على اتصال TCP واحد وقت الذروة
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .request(HTTPXRequest(
+            connection_pool_size=64,
+            http_version="2",
+            pool_timeout=5,
+            connect_timeout=10,
+            read_timeout=20,
+            write_timeout=20,
+        ))
+        .get_updates_request(HTTPXRequest(connection_pool_size=64, http_version="2"))
+        .post_init(post_init)
+        .post_shutdown(close_database)
+        .build()
+    )
 
     # ✅ أوامر البوت
     app.add_handler(CommandHandler("start", start))
 
-    app.add_handler(MessageHandler(
-        filters.ChatType.CHANNEL & filters.Regex(r"^✅ الزبون استلم طلبه رقم \d+ وقام بتقييمه بـ .+?\n📌 معرف الطلب: "), 
-        handle_order_delivered_rating
-    ))
-
     app.add_error_handler(error_handler)
 
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex("تردد الزبون"), handle_standard_cancellation_notice))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex("تأخر المطعم.*تم إنشاء تقرير"), handle_report_cancellation_notice))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex(r"تذكير من الزبون"), handle_channel_reminder))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.Regex(r"كم يتبقى.*الطلب رقم"), handle_time_left_question))
+    # ✅ موزّع واحد لرسائل القناة النصية بدل ستة مرشحات تُختبر بالتتابع
     app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.LOCATION, handle_channel_location))
-    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.TEXT, handle_channel_order))
+    app.add_handler(MessageHandler(filters.ChatType.CHANNEL & filters.TEXT, handle_channel_message))
 
     app.add_handler(CallbackQueryHandler(button, pattern=r"^(accept|reject|confirmreject|back|complain|report_(delivery|phone|location|other))_.+"))
     app.add_handler(CallbackQueryHandler(handle_time_selection, pattern=r"^time_\d+_.+"))
 
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("🚚 الدليفري"), handle_delivery_menu))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("➕ إضافة دليفري"), ask_add_delivery_name))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_add_delivery))  
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("❌ حذف دليفري"), handle_delete_delivery_menu))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_delete_delivery_choice))
+    # ✅ أزرار القوائم نصوص ثابتة — المطابقة بالتساوي (filters.Text) أرخص من أنماط Regex
+    app.add_handler(MessageHandler(filters.Text(["🚚 الدليفري"]), handle_delivery_menu))
+    app.add_handler(MessageHandler(filters.Text(["➕ إضافة دليفري"]), ask_add_delivery_name))
+    app.add_handler(MessageHandler(filters.Text(["❌ حذف دليفري"]), handle_delete_delivery_menu))
 
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("📊 عدد الطلبات اليوم والدخل"), handle_today_stats))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("📅 عدد الطلبات أمس والدخل"), handle_yesterday_stats))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("🗓️ طلبات الشهر الحالي"), handle_current_month_stats))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("📆 طلبات الشهر الماضي"), handle_last_month_stats))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("📈 طلبات السنة الحالية"), handle_current_year_stats))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("📉 طلبات السنة الماضية"), handle_last_year_stats))
-    app.add_handler(MessageHandler(filters.TEXT & filters.Regex("📋 إجمالي الطلبات والدخل"), handle_total_stats))
+    # ✅ أزرار الإحصائيات كلها عبر مرشح واحد ببحث مجموعة بدل سبعة أنماط تُختبر بالتتابع
+    app.add_handler(MessageHandler(filters.Text(set(STATS_LABELS)), dispatch_stats))
 
-    # ✅ تشغيل البوت
-    await app.run_polling()
+    # ✅ الموزّع الشامل للنصوص الحرة يُسجّل أخيرًا حتى لا يبتلع ضغطات الأزرار الثابتة
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_delivery_text))
 
-if __name__ == "__main__":
-    import nest_asyncio
-    nest_asyncio.apply()
+    # ✅ run_polling يدير الـ event loop بنفسه — لا حاجة لـ nest_asyncio أو run_forever
+    app.run_polling()
 
-    import logging
-    logging.basicConfig(
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        level=logging.INFO
-    )
+
+if __name__ == "__main__":
+    # ✅ التسجيل مُهيّأ مسبقًا عبر setup_logging (طابور + خيط خلفي) — لا حاجة لإعداد مكرر
     logging.getLogger("httpx").setLevel(logging.WARNING)
 
-    logging.info("🚀 جارٍ بدء تشغيل بوت المطعم (النسخة المعدلة للبيئات ذات الـ loop النشط).")
+    logger.info("🚀 جارٍ بدء تشغيل بوت المطعم.")
 
     try:
-        loop = asyncio.get_event_loop()
-        logging.info("📌 جدولة دالة run_bot على الـ event loop الموجود.")
-        task = loop.create_task(run_bot())
-
-        def _log_task_exception_if_any(task_future):
-            if task_future.done() and task_future.exception():
-                logging.error("❌ مهمة run_bot انتهت بخطأ:", exc_info=task_future.exception())
-
-        task.add_done_callback(_log_task_exception_if_any)
-
-        loop.run_forever()  # ⬅️ هذه تبقي البوت نشطًا للأبد
-
+        run_bot()
     except KeyboardInterrupt:
-        logging.info("🛑 تم إيقاف السكربت يدويًا (KeyboardInterrupt).")
+        logger.info("🛑 تم إيقاف السكربت يدويًا (KeyboardInterrupt).")
     except Exception as e:
-        logging.error(f"❌ حدث خطأ فادح في التنفيذ الرئيسي: {e}", exc_info=True)
+        logger.error(f"❌ حدث خطأ فادح في التنفيذ الرئيسي: {e}", exc_info=True)